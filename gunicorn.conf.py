@@ -0,0 +1,12 @@
+"""
+Gunicorn settings for production
+
+Run with: gunicorn main:app
+Uvicorn workers pick up uvloop and httptools automatically when installed.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8000)}"
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
@@ -1,11 +1,21 @@
 import os
-from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Depends
+import re
+import time
+import asyncio
+import hashlib
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Depends, Header, BackgroundTasks, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from bson import ObjectId
+from pymongo import ReturnDocument
+import orjson
 
-from database import db, create_document, get_documents
+from database import db, cache, create_document, bulk_insert
 from schemas import Team, TeamPublic, MatchRequest, MatchRequestPublic
 
 # Firebase Admin
@@ -28,201 +38,446 @@ if not firebase_admin._apps:
         # Firebase optional for local dev; continue without hard failure
         print("Firebase init warning:", e)
 
-app = FastAPI(title="FindRival API", version="1.0.0")
+app = FastAPI(title="FindRival API", version="1.0.0", default_response_class=ORJSONResponse)
+
+# Comma-separated list of browser origins; falls back to any origin (no credentials)
+ALLOWED_ORIGINS = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "").split(",") if o.strip()] or ["*"]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=ALLOWED_ORIGINS,
+    allow_credentials="*" not in ALLOWED_ORIGINS,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,
 )
 
+@app.on_event("startup")
+async def bound_default_executor():
+    # asyncio.to_thread work (token checks, FCM sends) shares one fixed pool
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=int(os.getenv("THREADPOOL_MAX_WORKERS", 32)))
+    )
+
+PUSHRESULT_TTL = 7 * 24 * 3600
+
+@app.on_event("startup")
+async def ensure_indexes():
+    if db is None:
+        return
+    try:
+        await db.team.create_index([("location", "2dsphere")])
+        await db.team.create_index([("sport", 1), ("location", "2dsphere")])
+        # Lets the from/to $or in list_match_requests use an index union
+        await db.matchrequest.create_index([("from_team_id", 1)])
+        await db.matchrequest.create_index([("to_team_id", 1)])
+        # Per-token FCM outcomes are short-lived diagnostics; Mongo expires them
+        await db.pushresult.create_index([("request_id", 1)])
+        await db.pushresult.create_index([("created_at", 1)], expireAfterSeconds=PUSHRESULT_TTL)
+    except Exception as e:
+        print("Index init warning:", e)
+
+@app.on_event("startup")
+async def warm_fcm():
+    if not firebase_admin._apps:
+        return
+    # Run in the background so a slow handshake doesn't hold up startup
+    app.state.fcm_warmup = asyncio.create_task(asyncio.to_thread(_warm_fcm))
+
 # Utilities
 class AuthHeader(BaseModel):
     authorization: Optional[str] = None
 
-def verify_firebase_token(authorization: Optional[str]) -> Optional[str]:
+# Verified tokens keyed by a digest of the raw token -> (uid, exp)
+_TOKEN_CACHE: "OrderedDict[bytes, Tuple[Optional[str], float]]" = OrderedDict()
+_TOKEN_CACHE_MAX = 10000
+
+async def verify_firebase_token(authorization: Optional[str] = Header(None)) -> Optional[str]:
     if not authorization or not authorization.lower().startswith("bearer "):
         return None
     token = authorization.split(" ", 1)[1]
+    key = hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+
+    hit = _TOKEN_CACHE.get(key)
+    if hit:
+        uid, exp = hit
+        if time.time() < exp:
+            _TOKEN_CACHE.move_to_end(key)
+            return uid
+        _TOKEN_CACHE.pop(key, None)
+
+    # Signature verification is sync (and may fetch certs), keep it off the loop
     try:
-        decoded = auth.verify_id_token(token)
-        return decoded.get("uid")
+        decoded = await asyncio.to_thread(auth.verify_id_token, token)
     except Exception:
         return None
 
+    uid = decoded.get("uid")
+    _TOKEN_CACHE[key] = (uid, float(decoded.get("exp", 0)))
+    if len(_TOKEN_CACHE) > _TOKEN_CACHE_MAX:
+        _TOKEN_CACHE.popitem(last=False)
+    return uid
+
+_UUID_HEX = re.compile(r"[0-9a-fA-F]{32}")
+
+async def request_id_filter(request_id: str) -> dict:
+    # Match requests are keyed by uuid hex strings; older ones still use ObjectId.
+    # Anything else is rejected before it reaches Mongo.
+    if _UUID_HEX.fullmatch(request_id):
+        return {"_id": request_id.lower()}
+    if len(request_id) == 24 and ObjectId.is_valid(request_id):
+        return {"_id": ObjectId(request_id)}
+    raise HTTPException(status_code=400, detail=f"Invalid request id {request_id}")
+
+# Fields needed to build TeamPublic; skips device_tokens and owner data
+TEAM_PUBLIC_PROJECTION = {
+    "name": 1,
+    "sport": 1,
+    "location": 1,
+    "address": 1,
+    "players": 1,
+    "availability": 1,
+}
+
 # Routes
 @app.get("/")
-def root():
+async def root():
     return {"service": "FindRival API", "version": "1.0.0"}
 
 # 1) Team creation & listing
 @app.post("/teams", response_model=TeamPublic)
-def create_team(team: Team):
-    # Ensure 2dsphere index exists
-    try:
-        db.team.create_index([("location", "2dsphere")])
-    except Exception:
-        pass
-
-    inserted_id = create_document("team", team)
-    return TeamPublic(
-        id=inserted_id,
-        name=team.name,
-        sport=team.sport,
-        location=team.location.model_dump(),
-        address=team.address,
-        players=team.players,
-        availability=team.availability,
-    )
+async def create_team(team: Team):
+    doc = team.model_dump()
+    doc["_id"] = await create_document("team", doc)
+    await _cache_invalidate(TEAMS_CACHE_PREFIX + "*")
+    return ORJSONResponse(_team_public_dict(doc))
 
 @app.get("/teams", response_model=List[TeamPublic])
-def list_teams(sport: Optional[str] = None):
+async def list_teams(sport: Optional[str] = None):
+    # Unbounded result set: streamed straight through, never cached
     filt = {"sport": sport} if sport else {}
-    teams = get_documents("team", filt)
-    result = []
-    for t in teams:
-        result.append(
-            TeamPublic(
-                id=str(t.get("_id")),
-                name=t.get("name"),
-                sport=t.get("sport"),
-                location=t.get("location"),
-                address=t.get("address"),
-                players=t.get("players", []),
-                availability=t.get("availability", {}),
-            )
-        )
-    return result
+    docs = db.team.find(filt, TEAM_PUBLIC_PROJECTION)
+    first = await _first_doc(docs)
+    return StreamingResponse(
+        _json_array(docs, _team_public_dict, first=first), media_type="application/json"
+    )
 
 # 2) Nearby opponent finder (GPS + filters)
+# Results are unordered by default; pass ?sorted=true for nearest-first
 @app.get("/teams/nearby", response_model=List[TeamPublic])
-def nearby_teams(
+async def nearby_teams(
     lng: float,
     lat: float,
     max_km: float = 25.0,
     sport: Optional[str] = None,
     timeslot: Optional[str] = None,
+    by_distance: bool = Query(False, alias="sorted"),
 ):
-    geo_filter = {
-        "location": {
-            "$near": {
-                "$geometry": {"type": "Point", "coordinates": [lng, lat]},
-                "$maxDistance": int(max_km * 1000),
-            }
-        }
-    }
-    filt = geo_filter
-    if sport:
-        filt["sport"] = sport
-    if timeslot:
-        filt["availability.timeslot"] = timeslot
+    key = f"{TEAMS_CACHE_PREFIX}nb:{sport or ''}:{timeslot or ''}:{round(lng, 3)}:{round(lat, 3)}:{max_km!r}:{int(by_distance)}"
+    hit, gen = await _cache_get(key)
+    if hit is not None:
+        return Response(content=hit, media_type="application/json")
 
+    pipeline = _nearby_pipeline(
+        lng, lat, max_km, sport, timeslot, TEAM_PUBLIC_PROJECTION, by_distance
+    )
+    docs = db.team.aggregate(pipeline)
+    # Pull the first doc eagerly so geo query errors still surface as a 400
     try:
-        docs = db.team.find(filt).limit(50)
+        first = await _first_doc(docs)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Geo query failed: {e}")
+    return StreamingResponse(
+        _cache_stream(key, gen, _json_array(docs, _team_public_dict, first=first)),
+        media_type="application/json",
+    )
 
-    result = []
+# Map-marker variant: same search, returned as parallel arrays
+@app.get("/teams/nearby/compact")
+async def nearby_teams_compact(
+    lng: float,
+    lat: float,
+    max_km: float = 25.0,
+    sport: Optional[str] = None,
+    timeslot: Optional[str] = None,
+    by_distance: bool = Query(False, alias="sorted"),
+):
+    key = f"{TEAMS_CACHE_PREFIX}nbc:{sport or ''}:{timeslot or ''}:{round(lng, 3)}:{round(lat, 3)}:{max_km!r}:{int(by_distance)}"
+    hit, gen = await _cache_get(key)
+    if hit is not None:
+        return Response(content=hit, media_type="application/json")
+
+    projection = {"name": 1, "sport": 1, "location.coordinates": 1}
+    pipeline = _nearby_pipeline(lng, lat, max_km, sport, timeslot, projection, by_distance)
+
+    try:
+        docs = await db.team.aggregate(pipeline).to_list(length=None)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Geo query failed: {e}")
+
+    ids, names, sports, lngs, lats = [], [], [], [], []
     for t in docs:
-        result.append(
-            TeamPublic(
-                id=str(t.get("_id")),
-                name=t.get("name"),
-                sport=t.get("sport"),
-                location=t.get("location"),
-                address=t.get("address"),
-                players=t.get("players", []),
-                availability=t.get("availability", {}),
-            )
-        )
-    return result
+        coords = t["location"]["coordinates"]
+        ids.append(str(t["_id"]))
+        names.append(t.get("name"))
+        sports.append(t.get("sport"))
+        lngs.append(coords[0])
+        lats.append(coords[1])
+
+    body = orjson.dumps({"ids": ids, "names": names, "sports": sports, "lngs": lngs, "lats": lats})
+    await _cache_set(key, gen, body)
+    return Response(content=body, media_type="application/json")
 
 # 3) Match request system
 @app.post("/match-requests", response_model=MatchRequestPublic)
-def send_match_request(req: MatchRequest):
-    # Basic validation: ensure teams exist
-    for tid in [req.from_team_id, req.to_team_id]:
-        if not db.team.find_one({"_id": ObjectId(tid)}):
+async def send_match_request(req: MatchRequest, background_tasks: BackgroundTasks):
+    # Basic validation: ensure teams exist (one round trip for both)
+    oids = [ObjectId(req.from_team_id), ObjectId(req.to_team_id)]
+    found = {
+        d["_id"]: d
+        async for d in db.team.find({"_id": {"$in": oids}}, {"device_tokens": 1})
+    }
+    for tid, oid in zip([req.from_team_id, req.to_team_id], oids):
+        if oid not in found:
             raise HTTPException(status_code=404, detail=f"Team {tid} not found")
 
-    rid = create_document("matchrequest", req)
+    doc = req.model_dump()
+    # String ids go straight into URLs and filters without ObjectId round trips
+    rid = doc["_id"] = uuid.uuid4().hex
+    await create_document("matchrequest", doc)
 
-    # Push notification to target team (if tokens available)
-    try:
-        to_team = db.team.find_one({"_id": ObjectId(req.to_team_id)})
-        tokens = to_team.get("device_tokens", []) if to_team else []
-        if tokens:
-            message = messaging.MulticastMessage(
-                tokens=tokens,
-                notification=messaging.Notification(
-                    title="New Match Request",
-                    body="You have a new match request",
-                ),
-                data={
-                    "type": "match_request",
-                    "id": rid,
-                },
-            )
-            messaging.send_multicast(message)
-    except Exception as e:
-        print("FCM send warning:", e)
+    # Push notification to target team (if tokens available), after the response
+    tokens = found[oids[1]].get("device_tokens", [])
+    if tokens:
+        background_tasks.add_task(_send_fcm, tokens, rid)
 
-    return MatchRequestPublic(
-        id=rid,
-        from_team_id=req.from_team_id,
-        to_team_id=req.to_team_id,
-        status=req.status,
-        proposed_time=req.proposed_time,
-        notes=req.notes,
-    )
+    return ORJSONResponse(_req_public_dict(doc))
 
 @app.post("/match-requests/{request_id}/accept", response_model=MatchRequestPublic)
-def accept_request(request_id: str):
-    res = db.matchrequest.update_one({"_id": ObjectId(request_id)}, {"$set": {"status": "accepted"}})
-    if res.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Request not found")
-    req = db.matchrequest.find_one({"_id": ObjectId(request_id)})
-    return _req_public(req)
+async def accept_request(filt: dict = Depends(request_id_filter)):
+    return await _set_status(filt, "accepted")
 
 @app.post("/match-requests/{request_id}/reject", response_model=MatchRequestPublic)
-def reject_request(request_id: str):
-    res = db.matchrequest.update_one({"_id": ObjectId(request_id)}, {"$set": {"status": "rejected"}})
-    if res.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Request not found")
-    req = db.matchrequest.find_one({"_id": ObjectId(request_id)})
-    return _req_public(req)
+async def reject_request(filt: dict = Depends(request_id_filter)):
+    return await _set_status(filt, "rejected")
 
 @app.post("/match-requests/{request_id}/confirm", response_model=MatchRequestPublic)
-def confirm_request(request_id: str):
-    res = db.matchrequest.update_one({"_id": ObjectId(request_id)}, {"$set": {"status": "confirmed"}})
-    if res.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Request not found")
-    req = db.matchrequest.find_one({"_id": ObjectId(request_id)})
-    return _req_public(req)
+async def confirm_request(filt: dict = Depends(request_id_filter)):
+    return await _set_status(filt, "confirmed")
 
 @app.get("/match-requests", response_model=List[MatchRequestPublic])
-def list_match_requests(team_id: Optional[str] = None):
+async def list_match_requests(team_id: Optional[str] = None):
     filt = {}
     if team_id:
         filt = {"$or": [{"from_team_id": team_id}, {"to_team_id": team_id}]}
     docs = db.matchrequest.find(filt).limit(100)
-    return [_req_public(d) for d in docs]
+    first = await _first_doc(docs)
+    return StreamingResponse(
+        _json_array(docs, _req_public_dict, first=first), media_type="application/json"
+    )
 
 # Helpers
 
-def _req_public(d) -> MatchRequestPublic:
-    return MatchRequestPublic(
-        id=str(d.get("_id")),
-        from_team_id=d.get("from_team_id"),
-        to_team_id=d.get("to_team_id"),
-        status=d.get("status"),
-        proposed_time=d.get("proposed_time"),
-        notes=d.get("notes"),
+async def _first_doc(docs):
+    # Read ahead one doc so query errors raise before the response starts
+    try:
+        return await docs.next()
+    except StopAsyncIteration:
+        return None
+
+async def _json_array(docs, to_dict, first=None):
+    # Encode a cursor as a JSON array one document at a time
+    yield b"["
+    if first is not None:
+        yield orjson.dumps(to_dict(first))
+    sep = b"," if first is not None else b""
+    async for d in docs:
+        yield sep + orjson.dumps(to_dict(d))
+        sep = b","
+    yield b"]"
+
+TEAMS_CACHE_PREFIX = "teams:"
+TEAMS_CACHE_TTL = 60
+# Bumped on every invalidation; lives outside the prefix so pattern deletes keep it
+TEAMS_CACHE_GEN_KEY = "teamscache:gen"
+
+# Store only if no invalidation ran since the reader fetched the generation
+_CACHE_SET_IF_GEN = """
+if tonumber(redis.call('GET', KEYS[2]) or '0') == tonumber(ARGV[1]) then
+    redis.call('SETEX', KEYS[1], ARGV[2], ARGV[3])
+end
+"""
+
+async def _cache_get(key: str) -> Tuple[Optional[bytes], int]:
+    if cache is None:
+        return None, 0
+    try:
+        hit, gen = await cache.mget(key, TEAMS_CACHE_GEN_KEY)
+        return hit, int(gen or 0)
+    except Exception as e:
+        print("Cache read warning:", e)
+        return None, 0
+
+async def _cache_stream(key: str, gen: int, chunks):
+    # Pass chunks through to the client, then store the full body
+    buf = []
+    async for chunk in chunks:
+        buf.append(chunk)
+        yield chunk
+    await _cache_set(key, gen, b"".join(buf))
+
+async def _cache_set(key: str, gen: int, body: bytes):
+    if cache is None:
+        return
+    try:
+        await cache.eval(_CACHE_SET_IF_GEN, 2, key, TEAMS_CACHE_GEN_KEY, gen, TEAMS_CACHE_TTL, body)
+    except Exception as e:
+        print("Cache write warning:", e)
+
+async def _cache_invalidate(pattern: str):
+    if cache is None:
+        return
+    try:
+        # Bump first so in-flight readers drop their now-stale bodies
+        await cache.incr(TEAMS_CACHE_GEN_KEY)
+        keys = [k async for k in cache.scan_iter(match=pattern)]
+        if keys:
+            await cache.unlink(*keys)
+    except Exception as e:
+        print("Cache invalidate warning:", e)
+
+EARTH_RADIUS_KM = 6378.1
+
+def _nearby_pipeline(lng, lat, max_km, sport, timeslot, projection, by_distance=False) -> list:
+    query = {}
+    if sport:
+        query["sport"] = sport
+    if timeslot:
+        query["availability.timeslot"] = timeslot
+
+    if by_distance:
+        # Nearest-first; pays for a distance sort over every team in range
+        match = {
+            "$geoNear": {
+                "near": {"type": "Point", "coordinates": [lng, lat]},
+                # Two 2dsphere indexes cover location, so name the field explicitly
+                "key": "location",
+                "distanceField": "dist_m",
+                "maxDistance": int(max_km * 1000),
+                "spherical": True,
+                "query": query,
+            }
+        }
+    else:
+        # Unordered: any 50 teams within max_km, straight off the 2dsphere index
+        query["location"] = {
+            "$geoWithin": {"$centerSphere": [[lng, lat], max_km / EARTH_RADIUS_KM]}
+        }
+        match = {"$match": query}
+
+    return [match, {"$limit": 50}, {"$project": projection}]
+
+def _team_public_dict(t) -> dict:
+    availability = {"days": [], "timeslot": "any"}
+    availability.update(t.get("availability") or {})
+    return {
+        "id": str(t.get("_id")),
+        "name": t.get("name"),
+        "sport": t.get("sport"),
+        "location": t.get("location"),
+        "address": t.get("address"),
+        "players": t.get("players", []),
+        "availability": availability,
+    }
+
+FCM_CHUNK_SIZE = 100
+
+def _warm_fcm():
+    # A dry-run send fetches the OAuth token and opens the pooled FCM
+    # connection, so the first real notification skips both handshakes.
+    # The placeholder token is always rejected; only the side effects matter.
+    try:
+        messaging.send(messaging.Message(token="warmup"), dry_run=True)
+    except Exception:
+        pass
+
+async def _send_fcm(tokens: List[str], rid: str):
+    # firebase_admin is sync; each chunk goes out on its own worker thread
+    try:
+        chunks = [tokens[i:i + FCM_CHUNK_SIZE] for i in range(0, len(tokens), FCM_CHUNK_SIZE)]
+        messages = [
+            messaging.MulticastMessage(
+                tokens=chunk,
+                notification=messaging.Notification(
+                    title="New Match Request",
+                    body="You have a new match request",
+                ),
+                data={
+                    "type": "match_request",
+                    "id": rid,
+                },
+            )
+            for chunk in chunks
+        ]
+        batches = await asyncio.gather(
+            *(asyncio.to_thread(messaging.send_each_for_multicast, m) for m in messages),
+            return_exceptions=True,
+        )
+    except Exception as e:
+        print("FCM send warning:", e)
+        return
+
+    # BatchResponse.responses line up 1:1 with the tokens of each chunk
+    results = []
+    for i, (chunk, batch) in enumerate(zip(chunks, batches)):
+        if isinstance(batch, Exception):
+            print(f"FCM send warning (chunk {i}):", batch)
+            continue
+        results.extend(
+            {
+                "request_id": rid,
+                "token": token,
+                "success": r.success,
+                "message_id": r.message_id,
+                "error": str(r.exception) if r.exception else None,
+            }
+            for token, r in zip(chunk, batch.responses)
+        )
+    try:
+        await bulk_insert("pushresult", results)
+    except Exception as e:
+        print("Push result log warning:", e)
+
+async def _set_status(filt: dict, status: str) -> ORJSONResponse:
+    # Update and read back in a single round trip
+    req = await db.matchrequest.find_one_and_update(
+        filt,
+        {"$set": {"status": status}},
+        return_document=ReturnDocument.AFTER,
     )
+    if not req:
+        raise HTTPException(status_code=404, detail="Request not found")
+    return ORJSONResponse(_req_public_dict(req))
 
+def _req_public_dict(d) -> dict:
+    return {
+        "id": str(d.get("_id")),
+        "from_team_id": d.get("from_team_id"),
+        "to_team_id": d.get("to_team_id"),
+        "status": d.get("status"),
+        "proposed_time": d.get("proposed_time"),
+        "notes": d.get("notes"),
+    }
+
+# Local entrypoint; production runs `gunicorn main:app` (see gunicorn.conf.py)
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", 2)),
+    )
@@ -5,7 +5,8 @@ Each Pydantic model represents a collection in MongoDB. Class name lowercased
 is used as the collection name by convention.
 """
 from __future__ import annotations
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+from bson import ObjectId
 from typing import List, Optional, Literal, Dict, Any
 
 class GeoPoint(BaseModel):
@@ -17,6 +18,8 @@ class Availability(BaseModel):
     timeslot: Optional[Literal["morning","afternoon","evening","any"]] = "any"
 
 class Team(BaseModel):
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True)
+
     owner_uid: str = Field(..., description="Firebase Auth user UID for the team owner")
     name: str
     sport: Literal["soccer","basketball","tennis","cricket","volleyball","badminton","rugby","hockey","other"]
@@ -27,12 +30,21 @@ class Team(BaseModel):
     device_tokens: List[str] = []
 
 class MatchRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True)
+
     from_team_id: str
     to_team_id: str
     status: Literal["pending","accepted","rejected","confirmed"] = "pending"
     proposed_time: Optional[str] = None
     notes: Optional[str] = None
 
+    @field_validator("from_team_id", "to_team_id")
+    @classmethod
+    def check_object_id(cls, v: str) -> str:
+        if not ObjectId.is_valid(v):
+            raise ValueError("must be a valid team id")
+        return v
+
 # Response models (lightweight)
 class TeamPublic(BaseModel):
     id: str